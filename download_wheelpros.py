@@ -1,18 +1,26 @@
 import os
-import re
 import io
+import csv
+import re
+import numbers
+import base64
 import requests
 import zipfile
+import hashlib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote, parse_qs, urlparse
-import glob
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import Request, AuthorizedSession
 from googleapiclient.discovery import build
 import gspread
+from gspread.utils import rowcol_to_a1
 
 # --- SETTINGS ---
 GMAIL_QUERY = 'from:(Inventory@aspecwheels.com OR data@wheelpros.com) subject:"INVENTORY FEED IS READY"'
@@ -20,7 +28,20 @@ TARGET_CSV = 'wheelInvPriceData.csv'
 SPREADSHEET_ID = '1lARcmMmdfrHePJk8bhOz2_ww1WZuY0cFW_-8HMJGSBo'
 SHEET_NAME = 'Sheet1'
 LOG_SHEET_NAME = 'Log'
+LOG_HEADER = [
+    "Upload Time",
+    "File Name",
+    "Rows",
+    "Sheet Range",
+    "Status",
+    "TotalQOH",
+    "Change from Previous Day"
+]
+SHEET_CHUNK_ROWS = 5000
 DOWNLOAD_DIR = r'C:\pythonScripts\Wheelpros\Download'
+HASH_FILE = os.path.join(DOWNLOAD_DIR, 'last_hash.txt')
+
+_WHEELPROS_URL_RE = re.compile(rb'https://backend\.api\.data\.wheelpros\.com/prod/feed/download[^"\'<\s]+')
 
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
@@ -42,195 +63,299 @@ def gmail_authenticate():
             token.write(creds.to_json())
     return creds
 
+def walk_parts(payload):
+    # Yield a message payload and all of its nested MIME parts
+    yield payload
+    for part in payload.get('parts', []):
+        yield from walk_parts(part)
+
 def get_latest_zip_link_from_gmail(service):
-    # --- Step 1: Get download link and email ID from latest email ---
+    # --- Step 1: Get download link from latest email, archive it ---
     results = service.users().messages().list(userId='me', q=GMAIL_QUERY, maxResults=1).execute()
     messages = results.get('messages', [])
     if not messages:
         raise Exception("No matching emails found.")
     msg_id = messages[0]['id']
-    msg = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    parts = msg['payload'].get('parts', [])
-    body = ""
-    if parts:
-        for part in parts:
-            if part['mimeType'] == 'text/plain':
-                body = part['body'].get('data', '')
-                break
-            elif part['mimeType'] == 'text/html':
-                body = part['body'].get('data', '')
-        import base64
-        if body:
-            body = base64.urlsafe_b64decode(body).decode('utf-8')
-    else:
-        import base64
-        body = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8')
-    match = re.search(r'https://backend\.api\.data\.wheelpros\.com/prod/feed/download[^"\'<\s]+', body)
+
+    # Fetch the message and mark it read/archived in one batched round trip
+    responses = {}
+    def store_response(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        responses[request_id] = response
+
+    batch = service.new_batch_http_request(callback=store_response)
+    batch.add(service.users().messages().get(userId='me', id=msg_id, format='full'), request_id='get')
+    batch.add(service.users().messages().modify(
+        userId='me',
+        id=msg_id,
+        body={'removeLabelIds': ['INBOX', 'UNREAD']}
+    ), request_id='modify')
+    batch.execute()
+    print("Archived and marked email as read.")
+
+    # Gmail has already undone the transfer encoding of every part; decode each
+    # body once and search them all together
+    msg = responses['get']
+    raw_bodies = [
+        base64.urlsafe_b64decode(part['body']['data'])
+        for part in walk_parts(msg['payload'])
+        if part.get('body', {}).get('data')
+    ]
+    match = _WHEELPROS_URL_RE.search(b'\n'.join(raw_bodies))
     if not match:
         raise Exception("Download link not found in email.")
-    return match.group(0), msg_id
+    return match.group(0).decode()
 
 def get_or_create_log_sheet(spreadsheet):
+    # Header row is written with the rest of the log in the batched update
     try:
         log_sheet = spreadsheet.worksheet(LOG_SHEET_NAME)
     except gspread.exceptions.WorksheetNotFound:
         log_sheet = spreadsheet.add_worksheet(title=LOG_SHEET_NAME, rows="1000", cols="7")
-        log_sheet.append_row([
-            "Upload Time",
-            "File Name",
-            "Rows",
-            "Sheet Range",
-            "Status",
-            "TotalQOH",
-            "Change from Previous Day"
-        ])
     return log_sheet
 
-def log_upload(log_sheet, upload_time, file_name, row_count, range_str, status_msg, total_qoh):
-    log_sheet.append_row([
-        upload_time,
-        file_name,
-        row_count,
-        range_str,
-        status_msg,
-        total_qoh,
-        ""  # Change from previous day, computed below
-    ])
-
-def sort_log_sheet(log_sheet):
-    values = log_sheet.get_all_values()
-    if len(values) <= 1:
-        return  # Only header
-    data = values[1:]
-    data.sort(key=lambda r: r[0], reverse=True)
-    log_sheet.clear()
-    log_sheet.append_row(values[0])
-    for row in data:
-        log_sheet.append_row(row)
-
-def compute_daily_change(log_sheet):
-    # --- Step 6: Compute 'Change from Previous Day' in log ---
-    values = log_sheet.get_all_values()
-    if len(values) < 3:
-        return
+def sort_log_rows(values):
+    header, data = values[0], sorted(values[1:], key=lambda r: str(r[0]), reverse=True)
+    return [header] + data
+
+def try_float(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+def parse_log_value(val):
+    num = try_float(val)
+    return val if num is None else num
+
+def compute_daily_change(values):
+    # --- Compute 'Change from Previous Day' for a sorted log (header first) ---
     totalqoh_col = 5
     change_col = 6
 
-    for i in range(1, len(values)):
-        try:
-            today_qoh = float(values[i][totalqoh_col])
-        except:
-            today_qoh = None
+    # Single reverse pass: the log is sorted newest first, so the previous
+    # day's QOH is the nearest parseable value below each row
+    qoh = [try_float(row[totalqoh_col]) for row in values[1:]]
+    prev = None
+    for k in range(len(qoh) - 1, -1, -1):
+        diff = qoh[k] - prev if (qoh[k] is not None and prev is not None) else ""
+        values[k + 1][change_col] = diff
+        if qoh[k] is not None:
+            prev = qoh[k]
+    return values
 
-        prev_qoh = None
-        for j in range(i + 1, len(values)):
-            try:
-                prev_val = float(values[j][totalqoh_col])
-                prev_qoh = prev_val
-                break
-            except:
-                continue
+def cell_data(val):
+    if isinstance(val, numbers.Number) and not isinstance(val, bool):
+        return {'userEnteredValue': {'numberValue': float(val)}}
+    return {'userEnteredValue': {'stringValue': str(val)}}
 
-        diff = today_qoh - prev_qoh if (today_qoh is not None and prev_qoh is not None) else ""
-        log_sheet.update_cell(i + 1, change_col + 1, diff)
+def resize_and_clear_requests(worksheet, row_count, col_count):
+    # batchUpdate requests that grow the grid if needed and clear all values
+    sheet_id = worksheet.id
+    return [
+        {'updateSheetProperties': {
+            'properties': {'sheetId': sheet_id, 'gridProperties': {
+                'rowCount': max(worksheet.row_count, row_count),
+                'columnCount': max(worksheet.col_count, col_count)
+            }},
+            'fields': 'gridProperties(rowCount,columnCount)'
+        }},
+        {'updateCells': {'range': {'sheetId': sheet_id}, 'fields': 'userEnteredValue'}},
+    ]
 
-def strip_leading_zeros(val):
-    # Remove leading zeros for numeric-only PartNumbers
-    if isinstance(val, str) and val.isdigit():
-        return str(int(val))
-    return val
+def update_cells_request(worksheet, rows, start_row=0):
+    # batchUpdate request writing rows starting at column A of the 0-based start_row
+    return {'updateCells': {
+        'start': {'sheetId': worksheet.id, 'rowIndex': start_row, 'columnIndex': 0},
+        'rows': [{'values': [cell_data(v) for v in row]} for row in rows],
+        'fields': 'userEnteredValue'
+    }}
 
-def main():
-    creds = gmail_authenticate()
-    gmail_service = build('gmail', 'v1', credentials=creds)
-    gs_client = gspread.authorize(creds)
-    spreadsheet = gs_client.open_by_key(SPREADSHEET_ID)
+def write_rows_requests(worksheet, rows):
+    # Replace the whole worksheet with rows starting at A1
+    return resize_and_clear_requests(worksheet, len(rows), max(len(r) for r in rows)) + [update_cells_request(worksheet, rows)]
 
+def upload_sheet_rows(spreadsheet, worksheet, rows):
+    # First batch resizes/clears Sheet1 and writes the first chunk; the remaining
+    # chunks go out concurrently over the shared session, each as its own request
+    # (retried individually by the client's backoff)
+    chunks = [rows[i:i + SHEET_CHUNK_ROWS] for i in range(0, len(rows), SHEET_CHUNK_ROWS)]
+    first_batch = resize_and_clear_requests(worksheet, len(rows), len(rows[0])) + [update_cells_request(worksheet, chunks[0])]
+    spreadsheet.batch_update({'requests': first_batch})
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [
+            pool.submit(spreadsheet.batch_update, {'requests': [update_cells_request(worksheet, chunk, i * SHEET_CHUNK_ROWS)]})
+            for i, chunk in enumerate(chunks[1:], start=1)
+        ]
+        for future in futures:
+            future.result()
+
+def log_upload(spreadsheet, log_sheet, entry):
+    # Existing log comes back as display strings; restore numbers so they stay numeric
+    log_values = [[parse_log_value(v) for v in row] for row in log_sheet.get_all_values()] or [LOG_HEADER]
+    log_values.append(entry)
+    log_values = compute_daily_change(sort_log_rows(log_values))
+    spreadsheet.batch_update({'requests': write_rows_requests(log_sheet, log_values)})
+
+def read_last_hash():
+    if not os.path.exists(HASH_FILE):
+        return None
+    with open(HASH_FILE) as f:
+        return f.read().strip()
+
+def save_last_hash(zip_hash):
+    with open(HASH_FILE, 'w') as f:
+        f.write(zip_hash)
+
+def import_feed(gmail_service, spreadsheet):
     print("Looking for latest Wheel Pros inventory email...")
-    # --- Step 1: Get download link and email ID from latest email ---
-    zip_url, msg_id = get_latest_zip_link_from_gmail(gmail_service)
+    # --- Step 1: Get download link from latest email ---
+    zip_url = get_latest_zip_link_from_gmail(gmail_service)
     print("Found ZIP link:", zip_url)
 
-    print("Downloading ZIP...")
-    resp = requests.get(zip_url)
-    if resp.status_code != 200:
-        raise Exception(f"Failed to download ZIP: {resp.status_code}")
-
     # --- Step 2: Download and save the ZIP with fallback filename ---
     now = datetime.now().strftime('%m-%d-%Y_%I-%M-%S-%p')
     file_name = f"wheelpros_{now}"
     zip_filename = f"{file_name}.zip"
     zip_path = os.path.join(DOWNLOAD_DIR, zip_filename)
 
-    print(f"Saving ZIP as: {zip_filename}")
-
-    with open(zip_path, 'wb') as f:
-        f.write(resp.content)
+    print(f"Downloading ZIP as: {zip_filename}")
+    # Stream straight to disk so the ZIP is never held in memory
+    with requests.get(zip_url, stream=True) as resp:
+        if resp.status_code != 200:
+            raise Exception(f"Failed to download ZIP: {resp.status_code}")
+        # Single pass over the response: write to disk and hash as it arrives.
+        # Download to a .part file so an interrupted transfer never lands in the archive
+        sha = hashlib.sha256()
+        part_path = zip_path + '.part'
+        try:
+            with open(part_path, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+                    sha.update(chunk)
+        except BaseException:
+            # Don't leave partial downloads behind; the prune step only sees *.zip
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+    os.replace(part_path, zip_path)
+    zip_hash = sha.hexdigest()
     print(f"Saved ZIP to {zip_path}")
 
     # --- Step 3: Prune old ZIPs, keep only the latest 10 ---
-    zip_files = sorted(
-        glob.glob(os.path.join(DOWNLOAD_DIR, '*.zip')),
-        key=os.path.getctime,
-        reverse=True
-    )
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        zip_files = [e for e in entries if e.is_file() and e.name.lower().endswith('.zip')]
+    zip_files.sort(key=lambda e: e.stat().st_ctime, reverse=True)
     for old_file in zip_files[10:]:
         try:
-            os.remove(old_file)
-            print(f"Deleted old ZIP: {old_file}")
+            os.remove(old_file.path)
+            print(f"Deleted old ZIP: {old_file.path}")
         except Exception as e:
-            print(f"Failed to delete {old_file}: {e}")
+            print(f"Failed to delete {old_file.path}: {e}")
+
+    log_sheet = get_or_create_log_sheet(spreadsheet)
+    upload_time = datetime.now().strftime("%Y-%m-%d %I:%M %p")
+    file_name_with_date = f"WheelPros Email – {upload_time}"
+
+    # --- Skip the Sheets upload if the feed is byte-identical to the last import ---
+    if zip_hash == read_last_hash():
+        status_msg = f"✓ {TARGET_CSV} unchanged since last import, upload skipped."
+        log_upload(spreadsheet, log_sheet, [upload_time, file_name_with_date, "", "", status_msg, "", ""])
+        print("Feed unchanged since last import; skipped upload. Log updated.")
+        return
 
     print("Extracting CSV from ZIP...")
     # --- Step 4: Extract CSV from ZIP ---
-    with zipfile.ZipFile(io.BytesIO(resp.content)) as z:
+    needed_columns = ['PartNumber', 'PartDescription', 'TotalQOH']
+    with zipfile.ZipFile(zip_path) as z:
         filelist = z.namelist()
         print("Files in ZIP:", filelist)
         target_path = next((f for f in filelist if f.lower().endswith('/' + TARGET_CSV.lower()) or f.lower() == TARGET_CSV.lower()), None)
         if not target_path:
             raise Exception(f"{TARGET_CSV} not found in ZIP!")
+        # Only the header line is decompressed here
         with z.open(target_path) as csvfile:
-            df = pd.read_csv(csvfile)
+            header = next(csv.reader(io.TextIOWrapper(csvfile, encoding='utf-8-sig', newline='')), [])
+        print("Columns in CSV:", header)
+        missing = [col for col in needed_columns if col not in header]
+        if missing:
+            raise Exception(f"Missing columns in CSV: {missing}")
 
-    print("Columns in CSV:", df.columns.tolist())
-    needed_columns = ['PartNumber', 'PartDescription', 'TotalQOH']
-    missing = [col for col in needed_columns if col not in df.columns]
-    if missing:
-        raise Exception(f"Missing columns in CSV: {missing}")
-    df_small = df[needed_columns].fillna('')
-    df_small['PartNumber'] = df_small['PartNumber'].apply(strip_leading_zeros)
+        # Arrow's multithreaded reader only tokenizes/converts the needed columns.
+        # TotalQOH is read as text and coerced below so stray values don't abort the import
+        convert_options = pacsv.ConvertOptions(
+            include_columns=needed_columns,
+            column_types={'PartNumber': pa.string(), 'PartDescription': pa.string(), 'TotalQOH': pa.string()}
+        )
+        with z.open(target_path) as csvfile:
+            try:
+                table = pacsv.read_csv(
+                    csvfile,
+                    # Quoted PartDescriptions can contain line breaks
+                    parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                    convert_options=convert_options
+                )
+            except pa.ArrowException as e:
+                raise Exception(f"Failed to read {TARGET_CSV}: {e}")
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
 
-    print(f"Uploading {len(df_small)} rows and {len(df_small.columns)} columns to Google Sheets...")
-    # --- Step 5: Upload to Google Sheets ---
+    df_small = df.fillna({'PartNumber': '', 'PartDescription': ''})
+    # Coerce via object dtype so blanks/junk become float64 NaN, which sum() skips
+    # (coercing the Arrow string column directly yields a NaN that isna() misses)
+    df_small['TotalQOH'] = pd.to_numeric(df_small['TotalQOH'].astype(object), errors='coerce')
+    # Remove leading zeros for numeric-only PartNumbers
+    part_numbers = df_small['PartNumber'].astype('string')
+    numeric = part_numbers.str.fullmatch(r'\d+').fillna(False)
+    stripped = part_numbers.where(~numeric, part_numbers.str.lstrip('0').replace('', '0'))
+    df_small['PartNumber'] = stripped.fillna(part_numbers)
+
+    # --- Step 5: Build Sheet1 rows ---
     worksheet = spreadsheet.worksheet(SHEET_NAME)
-    worksheet.clear()
-    worksheet.update([df_small.columns.values.tolist()] + df_small.values.tolist())
-    print("Upload to Sheet1 done.")
+    # Convert column-at-a-time and stack, avoiding pandas' row-wise object dispatch
+    columns = [df_small[c].astype(object).fillna('').to_numpy() for c in df_small.columns]
+    sheet_rows = [df_small.columns.tolist()] + np.column_stack(columns).tolist()
 
-    # --- Step 6: Log import to Log sheet ---
-    log_sheet = get_or_create_log_sheet(spreadsheet)
-    upload_time = datetime.now().strftime("%Y-%m-%d %I:%M %p")
-    file_name_with_date = f"WheelPros Email – {upload_time}"
+    # --- Step 6: Build the Log entry ---
     row_count = len(df_small)
     col_count = len(df_small.columns)
     last_row = row_count + 1
-    col_letter = chr(64 + col_count) if col_count <= 26 else f"Z"
-    range_str = f"A2:{col_letter}{last_row}"
+    range_str = f"A2:{rowcol_to_a1(last_row, col_count)}"
     status_msg = "✅ wheelInvPriceData.csv imported successfully."
-    total_qoh = float(df_small['TotalQOH'].apply(pd.to_numeric, errors='coerce').sum())
+    total_qoh = float(df_small['TotalQOH'].sum(skipna=True))
 
-    log_upload(log_sheet, upload_time, file_name_with_date, row_count, range_str, status_msg, total_qoh)
-    sort_log_sheet(log_sheet)
-    compute_daily_change(log_sheet)
+    # --- Step 7: Upload Sheet1 in chunks, then rewrite the log in one batchUpdate ---
+    print(f"Uploading {len(df_small)} rows and {len(df_small.columns)} columns to Google Sheets...")
+    upload_sheet_rows(spreadsheet, worksheet, sheet_rows)
+    print("Upload to Sheet1 done.")
+    log_upload(spreadsheet, log_sheet, [upload_time, file_name_with_date, row_count, range_str, status_msg, total_qoh, ""])
+    save_last_hash(zip_hash)
     print("Log updated.")
 
-    # --- Step 7: Mark email as read and archive ---
-    gmail_service.users().messages().modify(
-        userId='me',
-        id=msg_id,
-        body={'removeLabelIds': ['INBOX', 'UNREAD']}
-    ).execute()
-    print("Archived and marked email as read.")
+def main():
+    creds = gmail_authenticate()
+    gmail_service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+    # One pooled, keep-alive session for every Sheets call
+    session = AuthorizedSession(creds)
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    # BackOffHTTPClient retries 429/5xx responses with exponential backoff, so a
+    # chunk that hits the per-minute write quota is retried instead of failing
+    gs_client = gspread.Client(auth=creds, session=session, http_client=gspread.BackOffHTTPClient)
+    spreadsheet = gs_client.open_by_key(SPREADSHEET_ID)
+
+    # The email is archived as soon as it is read, so record any failure in the
+    # Log instead of leaving it unread in the inbox
+    try:
+        import_feed(gmail_service, spreadsheet)
+    except Exception as e:
+        upload_time = datetime.now().strftime("%Y-%m-%d %I:%M %p")
+        try:
+            log_upload(spreadsheet, get_or_create_log_sheet(spreadsheet), [
+                upload_time, f"WheelPros Email – {upload_time}", "", "", f"❌ Import failed: {e}", "", ""
+            ])
+        except Exception as log_error:
+            print(f"Failed to log import failure: {log_error}")
+        raise
 
 if __name__ == '__main__':
     main()